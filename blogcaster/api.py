@@ -1,16 +1,61 @@
 # api.py
-import datetime
+import asyncio
+import base64
+import functools
+import hashlib
+import json
 import os
 import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
+import anyio.to_thread
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
 from gtts import gTTS
 from pydantic import BaseModel
 
-app = FastAPI()
-
 MUSIC_DIR = "./music"
-os.makedirs(MUSIC_DIR, exist_ok=True)
+_MUSIC_DIR = MUSIC_DIR.rstrip("/") + "/"  # For building per-request paths
+
+# Patterns used by sanitize_filename, compiled once
+_SANITIZE_NON_WORD = re.compile(r"[^\w\s-]")
+_SANITIZE_RUN = re.compile(r"[-\s]+")
+
+# Synthesized audio keyed by a hash of the gTTS inputs, so repeated text skips the
+# network round trip. Kept outside MUSIC_DIR so it is neither listed in the player nor
+# served publicly under /music.
+CACHE_DIR = "./tts_cache"
+
+# gTTS calls spend nearly all their time waiting on the network, so each worker
+# process can keep many of them in flight on threads.
+THREAD_POOL_SIZE = 200
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    os.makedirs(MUSIC_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # asyncio.to_thread (gTTS) uses the loop's default executor; FileResponse and
+    # sync endpoints go through anyio's thread limiter. Raise both from their defaults.
+    executor = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+    asyncio.get_running_loop().set_default_executor(executor)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_POOL_SIZE
+    yield
+    executor.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
+# Saved audio is served as static files so the Streamlit player can stream it by URL
+# (with range requests) instead of loading each file into memory; point the app's
+# BLOGCASTER_AUDIO_BASE_URL at the browser-visible address of this. check_dir=False
+# because MUSIC_DIR is only created in lifespan.
+app.mount("/music", StaticFiles(directory=MUSIC_DIR, check_dir=False), name="music")
 
 
 class TextToSpeechRequest(BaseModel):
@@ -19,36 +64,120 @@ class TextToSpeechRequest(BaseModel):
 
 def sanitize_filename(text_snippet, max_length=50):
     # Remove special characters, replace spaces with underscores
-    s = re.sub(r"[^\w\s-]", "", text_snippet.lower())
-    s = re.sub(r"[-\s]+", "_", s).strip("_")
+    s = _SANITIZE_NON_WORD.sub("", text_snippet.lower())
+    s = _SANITIZE_RUN.sub("_", s).strip("_")
     return s[:max_length]
 
 
+@functools.lru_cache(maxsize=1024)
+def synthesize_cached(text, lang="en", slow=False):
+    """Returns the path of a cached mp3 for these inputs, calling gTTS only on a miss.
+
+    Blocking (network + disk), so call it from a worker thread.
+    """
+    key = hashlib.sha256(f"{lang}|{slow}|{text}".encode("utf-8")).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}.mp3")
+    if not os.path.exists(cache_path):
+        # Write to a temp file first so a concurrent request never sees a partial mp3
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            gTTS(text=text, lang=lang, slow=slow).save(tmp_path)
+            os.replace(tmp_path, cache_path)
+        finally:
+            # Only still there if gTTS failed part way through
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return cache_path
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def synthesize_request(text, persist):
+    """Returns (cache_path, filename) for text, saving a copy to MUSIC_DIR if persist."""
+    # Generate a unique filename
+    # Use a snippet of the text for a more descriptive filename
+    text_snippet = sanitize_filename(text.partition(".")[0] or text)
+    filename = f"{time.time_ns()}_{text_snippet}.mp3"
+
+    # gTTS does synchronous HTTP, so keep it off the event loop
+    cache_path = await asyncio.to_thread(synthesize_cached, text)
+    if not os.path.exists(cache_path):
+        # Cache file was removed behind our back; forget the stale entries and redo it
+        synthesize_cached.cache_clear()
+        cache_path = await asyncio.to_thread(synthesize_cached, text)
+
+    if persist:
+        # Copy rather than hard link: a link would share the cached file's old
+        # mtime and sort below older entries in the app's player.
+        await asyncio.to_thread(shutil.copyfile, cache_path, _MUSIC_DIR + filename)
+    return cache_path, filename
+
+
 @app.post("/text-to-speech/")
-async def convert_text_to_speech(request: TextToSpeechRequest):
+async def convert_text_to_speech(request: TextToSpeechRequest, persist: bool = False):
+    """Returns the mp3 directly; with ?persist=1 it is also saved to MUSIC_DIR."""
     if not request.text.strip():
         raise HTTPException(status_code=400, detail="Text input cannot be empty.")
 
     try:
-        # Generate a unique filename
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        # Use a snippet of the text for a more descriptive filename
-        text_snippet = sanitize_filename(
-            request.text.split(".")[0] if "." in request.text else request.text
-        )
-        filename = f"{timestamp}_{text_snippet}.mp3"
-        filepath = os.path.join(MUSIC_DIR, filename)
-
-        tts = gTTS(text=request.text, lang="en", slow=False)
-        tts.save(filepath)
-
-        return {"message": f"Audio saved as {filename}", "filename": filename}
+        cache_path, filename = await synthesize_request(request.text, persist)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating audio: {str(e)}")
 
+    headers = {"X-Saved-Filename": filename} if persist else {}
+    return FileResponse(
+        cache_path, media_type="audio/mpeg", filename=filename, headers=headers
+    )
+
+
+@app.post("/text-to-speech/events/")
+async def convert_text_to_speech_events(
+    request: TextToSpeechRequest, persist: bool = False
+):
+    """Same as /text-to-speech/, but reports progress as server-sent events.
+
+    Mirrors the local-model API's events endpoint: a "generating" event, then a
+    final "done" event with the filename (plus "audio_b64" when not persisted), or
+    an "error" event with a "detail".
+    """
+    if not request.text.strip():
+        raise HTTPException(status_code=400, detail="Text input cannot be empty.")
+
+    async def events():
+        yield f"data: {json.dumps({'status': 'generating'})}\n\n"
+        try:
+            cache_path, filename = await synthesize_request(request.text, persist)
+            done = {
+                "status": "done",
+                "filename": filename,
+                "saved": persist,
+                "media_type": "audio/mpeg",
+            }
+            if not persist:
+                audio = await asyncio.to_thread(read_file, cache_path)
+                done["audio_b64"] = base64.b64encode(audio).decode("ascii")
+            yield f"data: {json.dumps(done)}\n\n"
+        except Exception as e:
+            error = {"status": "error", "detail": f"Error generating audio: {str(e)}"}
+            yield f"data: {json.dumps(error)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 
 if __name__ == "__main__":
     import uvicorn
 
     # To run: uvicorn api:app --reload
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # No model state here, so this scales across processes: one worker per CPU.
+    # uvloop/httptools come with uvicorn[standard].
+    uvicorn.run(
+        "api:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=os.cpu_count(),
+        loop="uvloop",
+        http="httptools",
+    )
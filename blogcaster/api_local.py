@@ -1,148 +1,670 @@
 # api.py
-import datetime
+import asyncio
+import base64
+import gc
+import hashlib
+import io
+import json
 import os
 import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
+# Variable-length inputs fragment the CUDA caching allocator; expandable segments let it
+# grow existing blocks instead. Set before torch is imported so it is always picked up.
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128"
+)
+
+import numpy as np
 import soundfile as sf
 import torch
-from datasets import load_dataset  # For speaker embeddings
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from transformers import SpeechT5ForTextToSpeech, SpeechT5HifiGan, SpeechT5Processor
 
-app = FastAPI()
-
 MUSIC_DIR = "music"
-os.makedirs(MUSIC_DIR, exist_ok=True)
+_MUSIC_DIR = MUSIC_DIR.rstrip("/") + "/"  # For building per-request paths
 
-# --- Model Loading (Done once at startup) ---
-MODEL_LOADING_ERROR = None
-try:
-    print("Loading SpeechT5 models... This might take a while on the first run.")
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Using device: {device}")
+# Patterns used by sanitize_filename, compiled once
+_SANITIZE_NON_WORD = re.compile(r"[^\w\s-]")
+_SANITIZE_RUN = re.compile(r"[-\s]+")
 
-    processor = SpeechT5Processor.from_pretrained("microsoft/speecht5_tts")
-    model = SpeechT5ForTextToSpeech.from_pretrained("microsoft/speecht5_tts").to(device)
-    vocoder = SpeechT5HifiGan.from_pretrained("microsoft/speecht5_hifigan").to(device)
+# Run inference in FP16 on GPU (roughly halves generation time on tensor-core cards).
+# Set BLOGCASTER_FP16=0 to keep everything in FP32, e.g. when debugging audio quality.
+USE_FP16 = os.environ.get("BLOGCASTER_FP16", "1") != "0"
+
+# Compile the decoder/vocoder with torch.compile on GPU, fusing the many small kernels
+# of each autoregressive step. Set BLOGCASTER_COMPILE=0 to run eagerly.
+USE_COMPILE = os.environ.get("BLOGCASTER_COMPILE", "1") != "0"
+# Store the SpeechT5 Linear weights as int8 (bitsandbytes on GPU, torch dynamic
+# quantization on CPU). Set BLOGCASTER_INT8=1 to enable; check audio quality first.
+USE_INT8 = os.environ.get("BLOGCASTER_INT8", "0") == "1"
+# The postnet output projections audibly degrade when quantized, so keep them as is.
+INT8_SKIP_MODULES = ("speech_decoder_postnet.feat_out", "speech_decoder_postnet.prob_out")
+
+# Representative inputs run at startup so compilation doesn't land on the first request.
+WARMUP_TEXTS = (
+    "Hello there.",
+    "This sentence is a little longer, so the decoder sees a second, larger shape.",
+)
+
+# Speaker xvector, bundled next to this file so startup doesn't need the dataset.
+# It is row SPEAKER_XVECTOR_INDEX of Matthijs/cmu-arctic-xvectors (validation split).
+# If it isn't bundled, it is extracted from the dataset once and saved to a user cache
+# dir (never the source tree, which may be read-only). This fallback is the only thing
+# that needs the optional `datasets` package.
+SPEAKER_XVECTOR_PATH = os.path.join(os.path.dirname(__file__), "speaker_xvector.npy")
+SPEAKER_XVECTOR_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "blogcaster",
+    "speaker_xvector.npy",
+)
+SPEAKER_XVECTOR_INDEX = 0
+SPEAKER_ID = f"cmu-arctic-xvectors/validation/{SPEAKER_XVECTOR_INDEX}"
+
+# Concurrent requests are collected into one batched forward pass.
+MAX_BATCH_SIZE = 8
+MAX_BATCH_WAIT_MS = 50
+# Requests are only batched with others of a similar token length, so a short
+# sentence isn't padded out (and decoded) to the length of a long paragraph.
+LENGTH_BUCKETS = (32, 64, 128)
+# The sample rate for SpeechT5 is typically 16000 Hz
+SAMPLE_RATE = 16000  # Check model.config.sampling_rate if unsure, but SpeechT5 default is 16kHz
+
+# Long text is generated sentence by sentence so peak memory doesn't grow with input length.
+MAX_CHUNK_CHARS = 200
+CHUNK_SILENCE_SECONDS = 0.1
+CHUNK_FADE_SECONDS = 0.01
+
+# Number of decoder outputs (mel spectrograms) kept around for repeated text.
+SPECTROGRAM_CACHE_SIZE = 256
+
+
+# --- Request Batching ---
+def length_bucket(num_tokens):
+    for i, limit in enumerate(LENGTH_BUCKETS):
+        if num_tokens < limit:
+            return i
+    return len(LENGTH_BUCKETS)
+
+
+def spectrogram_cache_key(state, input_ids):
+    digest = hashlib.sha256(input_ids.cpu().numpy().tobytes()).hexdigest()
+    return (digest, state.speaker_id)
+
+
+def prepare_inputs(state, input_ids_list):
+    """Pads a group of token sequences and moves them to the device."""
+    pad_id = state.processor.tokenizer.pad_token_id
+    input_ids = torch.nn.utils.rnn.pad_sequence(
+        input_ids_list, batch_first=True, padding_value=pad_id
+    )
+    attention_mask = (input_ids != pad_id).long()
+    return input_ids.to(state.device), attention_mask.to(state.device)
+
+
+def generate_spectrograms(state, input_ids, attention_mask):
+    """Runs one batched encoder + autoregressive decoder pass, without the vocoder."""
+    batch_size = input_ids.shape[0]
+
+    spectrograms, lengths = state.model.generate_speech(
+        input_ids,
+        speaker_embeddings=state.speaker_embedding.expand(batch_size, -1),
+        attention_mask=attention_mask,
+        return_output_lengths=True,
+    )
+    if spectrograms.dim() == 2:
+        spectrograms = spectrograms.unsqueeze(0)
+    return [spectrograms[i, : int(lengths[i])] for i in range(batch_size)]
+
+
+def start_batch(state, input_ids_list):
+    """Looks up cached spectrograms; returns a plan for finish_batch."""
+    cache = state.spectrogram_cache
+    keys = [spectrogram_cache_key(state, ids) for ids in input_ids_list]
+    spectrograms = [None] * len(keys)
+    misses = []
+    for i, key in enumerate(keys):
+        if key in cache:
+            cache.move_to_end(key)
+            spectrograms[i] = cache[key]
+        else:
+            misses.append(i)
+
+    return keys, spectrograms, misses, [input_ids_list[i] for i in misses]
+
+
+def finish_batch(state, plan):
+    """Returns one waveform per input, decoding only the spectrograms that weren't cached.
+
+    The autoregressive decoder dominates generation time, so its output is kept in
+    an LRU cache; on a hit only the (cheap) vocoder runs.
+    """
+    keys, spectrograms, misses, missed_ids = plan
+    cache = state.spectrogram_cache
+
+    with torch.inference_mode(), torch.autocast(  # inference_mode: no autograd tracking
+        device_type="cuda", dtype=torch.float16, enabled=state.use_half
+    ):
+        if misses:
+            inputs = prepare_inputs(state, missed_ids)
+            generated = generate_spectrograms(state, *inputs)
+            for i, spectrogram in zip(misses, generated):
+                # Clone: the slice would otherwise keep the whole padded batch alive
+                spectrogram = spectrogram.clone()
+                spectrograms[i] = spectrogram
+                cache[keys[i]] = spectrogram
+            while len(cache) > SPECTROGRAM_CACHE_SIZE:
+                cache.popitem(last=False)
 
-    # Load xvector containing speaker's voice characteristics from a dataset
-    print("Loading speaker embeddings...")
-    embeddings_dataset = load_dataset(
-        "Matthijs/cmu-arctic-xvectors", split="validation"
+        return [state.vocoder(spectrogram) for spectrogram in spectrograms]
+
+
+def load_speaker_xvector():
+    """Returns the default speaker's 512-dim xvector as a float32 array."""
+    for path in (SPEAKER_XVECTOR_PATH, SPEAKER_XVECTOR_CACHE_PATH):
+        if os.path.exists(path):
+            return np.load(path)
+
+    # One-time fallback: pull the dataset (tens of MB) and keep just the one row.
+    # 'slt' (female) and 'bdl' (male) are other common CMU ARCTIC choices.
+    try:
+        from datasets import load_dataset  # Optional, only needed for this fallback
+    except ImportError as e:
+        raise RuntimeError(
+            f"{SPEAKER_XVECTOR_PATH} is missing and the optional 'datasets' package "
+            "isn't installed to extract it"
+        ) from e
+
+    print("Speaker xvector not bundled, extracting it from the dataset...")
+    embeddings_dataset = load_dataset("Matthijs/cmu-arctic-xvectors", split="validation")
+    xvector = np.asarray(
+        embeddings_dataset[SPEAKER_XVECTOR_INDEX]["xvector"], dtype=np.float32
     )
-    # Using a default speaker embedding (you can choose different speakers)
-    # For example, 'slt' (female), 'bdl' (male) are common in CMU ARCTIC
-    # Find an index for a speaker, e.g., by inspecting embeddings_dataset['speaker_id']
-    # For simplicity, let's try to find 'slt' or use the first one.
-    speaker_id_to_find = "slt"  # Example speaker
-    speaker_embedding = None
-    for i, sid in enumerate(embeddings_dataset["speaker_id"]):
-        # The speaker_id in this dataset might be numeric.
-        # We'll just pick one for demonstration. A real app might offer choices.
-        # For now, let's just pick the first available one as a default.
-        speaker_embedding = (
-            torch.tensor(embeddings_dataset[0]["xvector"]).unsqueeze(0).to(device)
+    try:
+        os.makedirs(os.path.dirname(SPEAKER_XVECTOR_CACHE_PATH), exist_ok=True)
+        np.save(SPEAKER_XVECTOR_CACHE_PATH, xvector)
+        print(f"Saved speaker xvector to {SPEAKER_XVECTOR_CACHE_PATH}")
+    except OSError as e:
+        # The in-memory xvector is all we need to serve
+        print(f"WARNING: could not save {SPEAKER_XVECTOR_CACHE_PATH}: {e}")
+    return xvector
+
+
+def load_tts_model(device, dtype):
+    """Loads SpeechT5 on device, optionally with int8 weights (see USE_INT8)."""
+    if USE_INT8 and device.type == "cuda":
+        from transformers import BitsAndBytesConfig  # Needs the optional bitsandbytes
+
+        # bitsandbytes places the weights itself, so no .to(device)/.half() here
+        return SpeechT5ForTextToSpeech.from_pretrained(
+            "microsoft/speecht5_tts",
+            quantization_config=BitsAndBytesConfig(
+                load_in_8bit=True, llm_int8_skip_modules=list(INT8_SKIP_MODULES)
+            ),
+            torch_dtype=dtype,
+            device_map={"": device.index or 0},
         )
-        print(
-            f"Using speaker embedding from index 0 (speaker_id: {embeddings_dataset[0]['speaker_id']})"
+
+    model = SpeechT5ForTextToSpeech.from_pretrained("microsoft/speecht5_tts").to(device)
+    if dtype == torch.float16:
+        model.half()
+    if USE_INT8:
+        # CPU: PyTorch's built-in dynamic int8 quantization of the Linear layers
+        qconfig_spec = {
+            name: torch.ao.quantization.default_dynamic_qconfig
+            for name, module in model.named_modules()
+            if isinstance(module, torch.nn.Linear) and name not in INT8_SKIP_MODULES
+        }
+        model = torch.ao.quantization.quantize_dynamic(
+            model, qconfig_spec=qconfig_spec, dtype=torch.qint8
+        )
+    print(f"Loaded SpeechT5 ({'int8' if USE_INT8 else dtype} weights)")
+    return model
+
+
+def compile_models(model, vocoder):
+    """Wraps the per-step decoder and the vocoder in torch.compile, in place.
+
+    generate_speech drives the decoder step by step through
+    model.speecht5.decoder.wrapped_decoder, so that is what gets compiled rather
+    than the top-level model (whose generate_speech would bypass the wrapper).
+
+    Both use mode="default" with dynamic shapes rather than "reduce-overhead":
+    past_key_values grows every decoder step and spectrogram lengths vary, so CUDA
+    graphs would be re-recorded for nearly every call. CUDA graph outputs would
+    also be overwritten by the next call, while finish_batch keeps one vocoder
+    output per chunk.
+    """
+    decoder = model.speecht5.decoder
+    decoder.wrapped_decoder = torch.compile(
+        decoder.wrapped_decoder, mode="default", dynamic=True, fullgraph=False
+    )
+    return torch.compile(vocoder, mode="default", dynamic=True, fullgraph=False)
+
+
+def warm_up(state):
+    """Runs a couple of uncached generations so compiled graphs are ready to serve."""
+    with torch.inference_mode(), torch.autocast(
+        device_type="cuda", dtype=torch.float16, enabled=state.use_half
+    ):
+        for text in WARMUP_TEXTS:
+            input_ids = state.processor(text=text, return_tensors="pt")["input_ids"][0]
+            inputs = prepare_inputs(state, [input_ids])
+            for spectrogram in generate_spectrograms(state, *inputs):
+                state.vocoder(spectrogram)
+
+
+async def batch_worker(state):
+    """Pulls (input_ids, future) pairs off state.tts_queue and resolves them in batches."""
+    queue = state.tts_queue
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + MAX_BATCH_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        buckets = {}
+        for input_ids, future in batch:
+            buckets.setdefault(length_bucket(input_ids.shape[-1]), []).append(
+                (input_ids, future)
+            )
+
+        # Skip requests whose client already went away
+        groups = [
+            [(ids, fut) for ids, fut in items if not fut.done()]
+            for items in buckets.values()
+        ]
+
+        for items in groups:
+            if not items:
+                continue
+            out_of_memory = False
+            try:
+                plan = start_batch(state, [ids for ids, _ in items])
+                # Generation blocks for seconds (especially on CPU), so it runs on the
+                # inference thread and the event loop keeps serving other requests.
+                speeches = await loop.run_in_executor(
+                    state.inference_executor, finish_batch, state, plan
+                )
+            except Exception as e:
+                out_of_memory = (
+                    isinstance(e, RuntimeError) and "out of memory" in str(e).lower()
+                )
+                # The traceback's frames hold the failed batch's device tensors; strip
+                # it (and any chained exception) so they can actually be freed.
+                e.__context__ = e.__cause__ = None
+                fail_futures(items, e.with_traceback(None))
+            else:
+                for (_, fut), speech in zip(items, speeches):
+                    if not fut.done():
+                        fut.set_result(speech)
+                del speeches
+            plan = None
+
+            if out_of_memory:
+                # Don't leave the allocator fragmented for the next batch
+                release_cuda_memory()
+
+
+def release_cuda_memory():
+    """Collects unreferenced tensors and returns cached CUDA blocks to the driver."""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def fail_futures(items, error):
+    for _, fut in items:
+        if not fut.done():
+            fut.set_exception(error)
+
+
+# --- Model Loading (Done once per process, at startup) ---
+# Models live on app.state rather than at module level so that importing this
+# module (e.g. the uvicorn --reload supervisor) doesn't load gigabytes of weights.
+# Each uvicorn worker is its own process, so --workers N means N copies in memory.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    os.makedirs(MUSIC_DIR, exist_ok=True)
+    app.state.model_loading_error = None
+    app.state.model = None
+    try:
+        print("Loading SpeechT5 models... This might take a while on the first run.")
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        print(f"Using device: {device}")
+
+        use_half = USE_FP16 and device.type == "cuda"
+        dtype = torch.float16 if use_half else torch.float32
+
+        processor = SpeechT5Processor.from_pretrained("microsoft/speecht5_tts")
+        model = load_tts_model(device, dtype)
+        vocoder = SpeechT5HifiGan.from_pretrained("microsoft/speecht5_hifigan").to(
+            device
         )
-        break
+        if use_half:
+            vocoder.half()
+        print(f"Inference precision: {dtype}")
+
+        # Load xvector containing speaker's voice characteristics.
+        # It is moved to the device (in the inference dtype) once here, so requests
+        # never copy it again.
+        print("Loading speaker embeddings...")
+        speaker_embedding = torch.from_numpy(load_speaker_xvector()).to(dtype).unsqueeze(0)
+        if device.type == "cuda":
+            speaker_embedding = speaker_embedding.pin_memory()
+        speaker_embedding = speaker_embedding.to(device, non_blocking=True)
+        print(f"Using speaker embedding {SPEAKER_ID}")
 
-    if speaker_embedding is None:
-        # Fallback if the specific speaker isn't found or logic is complex
-        print("Default speaker not found, using the first available embedding.")
-        speaker_embedding = (
-            torch.tensor(embeddings_dataset[0]["xvector"]).unsqueeze(0).to(device)
+        app.state.device = device
+        app.state.use_half = use_half
+        app.state.processor = processor
+        app.state.model = model
+        app.state.vocoder = vocoder
+        app.state.speaker_embedding = speaker_embedding
+        app.state.speaker_id = SPEAKER_ID
+        app.state.spectrogram_cache = OrderedDict()
+        print("Models and speaker embeddings loaded successfully.")
+
+        # A single inference thread per device: generations never run concurrently
+        # (which could OOM), and requests queue up in tts_queue meanwhile.
+        app.state.inference_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="tts-inference"
         )
 
-    print("Models and speaker embeddings loaded successfully.")
+        if USE_COMPILE and device.type == "cuda":
+            try:
+                print("Compiling decoder and vocoder with torch.compile...")
+                app.state.vocoder = compile_models(model, vocoder)
+                # Warm up on the inference thread, the same way requests will run.
+                # (Compiled code is shared across threads in mode="default"; only
+                # "reduce-overhead"'s CUDA graph trees would be per thread.) Running
+                # it there also keeps the event loop free while it compiles.
+                await asyncio.get_running_loop().run_in_executor(
+                    app.state.inference_executor, warm_up, app.state
+                )
+                print("Compilation and warm-up done.")
+            except Exception as e:
+                # Fall back to eager mode rather than refusing to serve
+                print(f"WARNING: torch.compile failed, running eagerly: {e}")
+                model.speecht5.decoder.wrapped_decoder = getattr(
+                    model.speecht5.decoder.wrapped_decoder,
+                    "_orig_mod",
+                    model.speecht5.decoder.wrapped_decoder,
+                )
+                app.state.vocoder = vocoder
+
+        app.state.tts_queue = asyncio.Queue()
+        app.state.batch_task = asyncio.create_task(batch_worker(app.state))
+
+    except Exception as e:
+        app.state.model_loading_error = f"Failed to load SpeechT5 models: {e}"
+        print(f"ERROR: {app.state.model_loading_error}")
+        # To prevent app from starting if models fail to load critically:
+        # raise RuntimeError(app.state.model_loading_error) # Or handle gracefully in endpoints
+
+    yield
+
+    batch_task = getattr(app.state, "batch_task", None)
+    if batch_task is not None:
+        batch_task.cancel()
+        try:
+            await batch_task
+        except asyncio.CancelledError:
+            pass
+    inference_executor = getattr(app.state, "inference_executor", None)
+    if inference_executor is not None:
+        inference_executor.shutdown(wait=True)
+
+    # Release model memory on shutdown so a reload cycle starts from a clean allocator
+    for name in (
+        "model",
+        "vocoder",
+        "processor",
+        "speaker_embedding",
+        "spectrogram_cache",
+    ):
+        if hasattr(app.state, name):
+            delattr(app.state, name)
+    release_cuda_memory()
 
-except Exception as e:
-    MODEL_LOADING_ERROR = f"Failed to load SpeechT5 models: {e}"
-    print(f"ERROR: {MODEL_LOADING_ERROR}")
-    # To prevent app from starting if models fail to load critically:
-    # raise RuntimeError(MODEL_LOADING_ERROR) # Or handle gracefully in endpoints
 
 # --- End Model Loading ---
 
+app = FastAPI(lifespan=lifespan)
+# Saved audio is served as static files so the Streamlit player can stream it by URL
+# (with range requests) instead of loading each file into memory; point the app's
+# BLOGCASTER_AUDIO_BASE_URL at the browser-visible address of this. check_dir=False
+# because MUSIC_DIR is only created in lifespan.
+app.mount("/music", StaticFiles(directory=MUSIC_DIR, check_dir=False), name="music")
+
 
 class TextToSpeechRequest(BaseModel):
     text: str
 
 
 def sanitize_filename(text_snippet, max_length=50):
-    s = re.sub(r"[^\w\s-]", "", text_snippet.lower())
-    s = re.sub(r"[-\s]+", "_", s).strip("_")
+    s = _SANITIZE_NON_WORD.sub("", text_snippet.lower())
+    s = _SANITIZE_RUN.sub("_", s).strip("_")
     return s[:max_length]
 
 
-@app.post("/text-to-speech/")
-async def convert_text_to_speech(request: TextToSpeechRequest):
-    if MODEL_LOADING_ERROR:
+def encode_wav(speech_numpy, sample_rate=SAMPLE_RATE):
+    """Encodes a float waveform in [-1, 1] as 16-bit PCM WAV bytes.
+
+    Half the size of soundfile's default float WAV, and encoded in memory so the
+    file is written with a single call.
+    """
+    pcm = np.clip(speech_numpy * 32767, -32768, 32767).astype(np.int16)
+    buf = io.BytesIO()
+    sf.write(buf, pcm, samplerate=sample_rate, subtype="PCM_16", format="WAV")
+    return buf.getvalue()
+
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_into_chunks(text, max_chars=MAX_CHUNK_CHARS):
+    """Splits text on sentence boundaries, packing sentences into chunks of <= max_chars.
+
+    A single sentence longer than max_chars is further split on whitespace.
+    """
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_BOUNDARY.split(text.strip()):
+        words = sentence.split()
+        pieces = []
+        piece = ""
+        for word in words:
+            if piece and len(piece) + 1 + len(word) > max_chars:
+                pieces.append(piece)
+                piece = word
+            else:
+                piece = f"{piece} {word}" if piece else word
+        if piece:
+            pieces.append(piece)
+
+        for piece in pieces:
+            if current and len(current) + 1 + len(piece) > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def join_chunks(waveforms, sample_rate=SAMPLE_RATE):
+    """Concatenates chunk waveforms with a short silence, fading the edges to avoid clicks."""
+    fade_len = int(CHUNK_FADE_SECONDS * sample_rate)
+    silence = np.zeros(int(CHUNK_SILENCE_SECONDS * sample_rate), dtype=np.float32)
+    parts = []
+    for i, waveform in enumerate(waveforms):
+        waveform = np.asarray(waveform, dtype=np.float32).copy()
+        n = min(fade_len, len(waveform) // 2)
+        if n > 0:
+            ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+            if i > 0:
+                waveform[:n] *= ramp
+            if i < len(waveforms) - 1:
+                waveform[-n:] *= ramp[::-1]
+        if i > 0:
+            parts.append(silence)
+        parts.append(waveform)
+    return np.concatenate(parts) if parts else silence[:0]
+
+
+def check_ready(state, request):
+    """Raises an HTTPException if the models aren't usable or the request is empty."""
+    if state.model_loading_error:
         raise HTTPException(
-            status_code=503, detail=f"Service Unavailable: {MODEL_LOADING_ERROR}"
+            status_code=503, detail=f"Service Unavailable: {state.model_loading_error}"
         )
-    if not hasattr(model, "generate_speech") or not hasattr(
-        processor, "__call__"
+    if not hasattr(state.model, "generate_speech") or not hasattr(
+        state.processor, "__call__"
     ):  # Basic check
         raise HTTPException(status_code=503, detail="TTS models not properly loaded.")
+    # Ensure speaker_embedding is loaded
+    if state.speaker_embedding is None:
+        raise HTTPException(status_code=500, detail="Speaker embedding not loaded.")
 
     if not request.text.strip():
         raise HTTPException(status_code=400, detail="Text input cannot be empty.")
 
+
+def tts_error_detail(e):
+    if isinstance(e, RuntimeError):  # Catch potential CUDA out of memory errors etc.
+        if "out of memory" in str(e).lower():
+            return f"Error generating audio: CUDA out of memory. Try shorter text or a smaller batch if applicable. Details: {str(e)}"
+        return f"Error generating audio: {str(e)}"
+    return f"An unexpected error occurred during TTS: {str(e)}"
+
+
+def write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+async def run_tts(state, text, persist):
+    """Runs the TTS pipeline for one request, yielding progress events as dicts.
+
+    The last event has status "done" and carries the filename and the WAV bytes.
+    If the caller stops iterating early, chunks not yet generated are cancelled.
+    """
+    yield {"status": "tokenizing"}
+    # Hand each chunk's tokens to the batching worker; chunks of one request
+    # can be decoded together in the same batch.
+    loop = asyncio.get_running_loop()
+    futures = []
     try:
-        inputs = processor(text=request.text, return_tensors="pt").to(device)
-
-        # Generate speech
-        # Ensure speaker_embedding is not None and is on the correct device
-        if speaker_embedding is None:
-            raise HTTPException(status_code=500, detail="Speaker embedding not loaded.")
-
-        with torch.no_grad():  # Important for inference
-            speech = model.generate_speech(
-                inputs["input_ids"],
-                speaker_embeddings=speaker_embedding.to(device),
-                vocoder=vocoder.to(device),
-            )
+        for chunk in split_into_chunks(text):
+            inputs = state.processor(text=chunk, return_tensors="pt")
+            future = loop.create_future()
+            await state.tts_queue.put((inputs["input_ids"][0], future))
+            futures.append(future)
 
-        # The output is a tensor, convert to numpy array
-        speech_numpy = speech.cpu().numpy()
+        yield {"status": "generating", "chunks": len(futures)}
+        speeches = await asyncio.gather(*futures)
+    finally:
+        # No-op for finished chunks; the batch worker skips cancelled ones
+        for future in futures:
+            future.cancel()
 
-        # Sanitize filename and create a filepath
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        text_snippet = sanitize_filename(
-            request.text.split(".")[0] if "." in request.text else request.text
-        )
+    yield {"status": "encoding"}
+    # The outputs are tensors, convert to numpy arrays
+    # (soundfile can't write float16, so upcast first)
+    speech_numpy = join_chunks([s.float().cpu().numpy() for s in speeches])
 
-        # Outputting as WAV as it's more direct from the model.
-        # Streamlit can play WAV. If MP3 is a hard requirement, you'd need an extra step (e.g., pydub+ffmpeg).
-        filename = f"{timestamp}_{text_snippet}.wav"  # Note: .wav extension
-        filepath = os.path.join(MUSIC_DIR, filename)
+    # Sanitize filename and create a filepath
+    text_snippet = sanitize_filename(text.partition(".")[0] or text)
 
-        # Save as WAV file
-        # The sample rate for SpeechT5 is typically 16000 Hz
-        sample_rate = 16000  # Check model.config.sampling_rate if unsure, but SpeechT5 default is 16kHz
-        sf.write(filepath, speech_numpy, samplerate=sample_rate)
+    # Outputting as WAV as it's more direct from the model.
+    # Streamlit can play WAV. If MP3 is a hard requirement, you'd need an extra step (e.g., pydub+ffmpeg).
+    filename = f"{time.time_ns()}_{text_snippet}.wav"  # Note: .wav extension
+    wav_bytes = encode_wav(speech_numpy)
 
-        return {"message": f"Audio saved as {filename}", "filename": filename}
-    except RuntimeError as e:  # Catch potential CUDA out of memory errors etc.
-        if "out of memory" in str(e).lower():
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error generating audio: CUDA out of memory. Try shorter text or a smaller batch if applicable. Details: {str(e)}",
-            )
-        raise HTTPException(status_code=500, detail=f"Error generating audio: {str(e)}")
+    if persist:
+        # Save as WAV file (in a thread, so the disk write doesn't block the loop)
+        await asyncio.to_thread(write_file, _MUSIC_DIR + filename, wav_bytes)
+
+    yield {
+        "status": "done",
+        "filename": filename,
+        "saved": persist,
+        "media_type": "audio/wav",
+        "wav": wav_bytes,
+    }
+
+
+@app.post("/text-to-speech/")
+async def convert_text_to_speech(
+    request: TextToSpeechRequest, http_request: Request, persist: bool = False
+):
+    """Returns the WAV directly; with ?persist=1 it is also saved to MUSIC_DIR."""
+    state = http_request.app.state
+    check_ready(state, request)
+
+    try:
+        async for event in run_tts(state, request.text, persist):
+            pass
     except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"An unexpected error occurred during TTS: {str(e)}"
-        )
+        raise HTTPException(status_code=500, detail=tts_error_detail(e))
+
+    filename = event["filename"]
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if persist:
+        headers["X-Saved-Filename"] = filename
+    return Response(content=event["wav"], media_type="audio/wav", headers=headers)
+
+
+@app.post("/text-to-speech/events/")
+async def convert_text_to_speech_events(
+    request: TextToSpeechRequest, http_request: Request, persist: bool = False
+):
+    """Same as /text-to-speech/, but reports progress as server-sent events.
+
+    Each event is JSON with a "status" of "tokenizing", "generating" or "encoding",
+    then a final "done" event with the filename (plus "audio_b64" when not
+    persisted), or an "error" event with a "detail". Closing the connection
+    cancels whatever hasn't been generated yet.
+    """
+    state = http_request.app.state
+    check_ready(state, request)
+
+    async def events():
+        try:
+            async for event in run_tts(state, request.text, persist):
+                if event["status"] == "done":
+                    wav_bytes = event.pop("wav")
+                    if not persist:
+                        event["audio_b64"] = base64.b64encode(wav_bytes).decode("ascii")
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            error = {"status": "error", "detail": tts_error_detail(e)}
+            yield f"data: {json.dumps(error)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    # To run: uvicorn api:app --reload
-    # Note: --reload might cause issues with GPU memory if models are reloaded frequently.
-    # For production, run without --reload once stable.
+    # To run: uvicorn api_local:app --reload
+    # Models are loaded in the lifespan handler, so each (re)started worker loads them once.
+    # Avoid --workers N here: every worker is a separate process with its own copy on the GPU.
+    # Keep this at one worker per GPU; on a multi-GPU host run one instance per device
+    # (e.g. CUDA_VISIBLE_DEVICES=1 ... --port 8001) behind a load balancer.
     uvicorn.run(app, host="0.0.0.0", port=8000)
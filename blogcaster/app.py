@@ -1,29 +1,56 @@
 # app.py
+import base64
 import datetime
+import json
 import os
 import re
+from urllib.parse import quote
 
-import requests
+import httpx
 import streamlit as st
 
 # --- Configuration ---
 API_URL = "http://127.0.0.1:8000/text-to-speech/"
+EVENTS_URL = API_URL + "events/"  # Same conversion, with progress as server-sent events
+# Public URL under which the API's /music mount is reachable *from the browser*,
+# e.g. "http://myhost:8000/music/". When set, the sidebar player streams files from
+# there; when unset, files are served through Streamlit itself (read into memory).
+AUDIO_BASE_URL = os.environ.get("BLOGCASTER_AUDIO_BASE_URL", "")
+if AUDIO_BASE_URL and not AUDIO_BASE_URL.endswith("/"):
+    AUDIO_BASE_URL += "/"
+STATUS_LABELS = {
+    "tokenizing": "✂️ Splitting and tokenizing text...",
+    "generating": "⚙️ Generating speech...",
+    "encoding": "💾 Encoding audio...",
+}
 MUSIC_DIR = "music"
 os.makedirs(MUSIC_DIR, exist_ok=True)
 
 
 # --- Helper Functions ---
-def get_audio_files():
-    """Lists .wav (and optionally .mp3) files in the MUSIC_DIR, sorted by modification time."""
+@st.cache_data(ttl=2)
+def get_audio_files(dir_mtime):
+    """Lists .wav (and optionally .mp3) files in the MUSIC_DIR, sorted by modification time.
+
+    dir_mtime is the directory's own mtime and only serves as the cache key: it changes
+    whenever a file is added or removed, so reruns in between reuse the cached listing.
+    """
+    # Now primarily looking for .wav files, but can include .mp3 for backward compatibility
+    with os.scandir(MUSIC_DIR) as it:
+        files = [
+            (entry.name, entry.stat().st_mtime)
+            for entry in it
+            if entry.is_file() and entry.name.endswith((".wav", ".mp3"))
+        ]
+    files.sort(key=lambda f: f[1], reverse=True)
+    return [name for name, _ in files]
+
+
+def list_audio_files():
     if not os.path.exists(MUSIC_DIR):
         return []
     try:
-        # Now primarily looking for .wav files, but can include .mp3 for backward compatibility
-        files = [f for f in os.listdir(MUSIC_DIR) if f.endswith((".wav", ".mp3"))]
-        files.sort(
-            key=lambda f: os.path.getmtime(os.path.join(MUSIC_DIR, f)), reverse=True
-        )
-        return files
+        return get_audio_files(os.path.getmtime(MUSIC_DIR))
     except Exception as e:
         st.sidebar.error(f"Error listing audio files: {e}")
         return []
@@ -38,7 +65,7 @@ st.set_page_config(
 st.sidebar.title("🎧 Audio Player")
 st.sidebar.caption("Listen to generated audio (Hugging Face Model)")  # Updated caption
 
-audio_files_list = get_audio_files()
+audio_files_list = list_audio_files()
 
 if not audio_files_list:
     st.sidebar.info("No audio files found yet. Generate some from the main panel!")
@@ -49,13 +76,19 @@ else:
     if selected_audio_file:
         audio_path = os.path.join(MUSIC_DIR, selected_audio_file)
         try:
-            with open(audio_path, "rb") as ap:
-                # Determine format based on extension
-                file_extension = os.path.splitext(selected_audio_file)[1].lower()
-                audio_format = (
-                    "audio/wav" if file_extension == ".wav" else "audio/mpeg"
-                )  # mpeg for mp3
-                st.sidebar.audio(ap.read(), format=audio_format)
+            if not os.path.exists(audio_path):
+                raise FileNotFoundError(audio_path)
+            # Determine format based on extension
+            file_extension = os.path.splitext(selected_audio_file)[1].lower()
+            audio_format = (
+                "audio/wav" if file_extension == ".wav" else "audio/mpeg"
+            )  # mpeg for mp3
+            if AUDIO_BASE_URL:
+                # The browser streams the file from the API server on demand
+                audio_source = AUDIO_BASE_URL + quote(selected_audio_file)
+            else:
+                audio_source = audio_path
+            st.sidebar.audio(audio_source, format=audio_format)
             st.sidebar.markdown(f"Playing: **{selected_audio_file}**")
         except FileNotFoundError:
             st.sidebar.error(f"Error: File '{selected_audio_file}' not found.")
@@ -119,6 +152,10 @@ elif text_input.strip():
     final_text_to_convert = text_input
     source_of_text = "text area"
 
+save_to_library = st.checkbox(
+    "💾 Save audio to the 'music' folder", value=True, key="save_to_library_cb"
+)
+
 if st.button("🔊 Convert to Audio (Local Model)", key="main_submit_button"):
     if not final_text_to_convert.strip():
         st.warning(
@@ -126,38 +163,75 @@ if st.button("🔊 Convert to Audio (Local Model)", key="main_submit_button"):
         )
     else:
         st.info(f"Converting text from: {source_of_text} using local model.")
-        with st.spinner(
-            "⚙️ Converting text to audio (local model)... This can take some time."
-        ):
+        # Progress is streamed from the API as server-sent events, so the status box
+        # updates as the request moves along and stopping the app cancels the work.
+        with st.status(
+            "⚙️ Converting text to audio (local model)... This can take some time.",
+            expanded=False,
+        ) as status:
             try:
                 payload = {"text": final_text_to_convert}
-                # Local models can take longer, especially on CPU or for longer text
-                response = requests.post(
-                    API_URL, json=payload, timeout=300
-                )  # Increased timeout
-                response.raise_for_status()
-                result = response.json()
-                returned_filename = result.get("filename", "audio.wav")
-                st.success(
-                    f"✅ Success! Audio saved as '{returned_filename}' in the 'music' folder."
-                )
-                st.balloons()
-                # st.session_state.text_area_content = "" # Optional: clear input
-                st.experimental_rerun()  # Refresh audio list in sidebar
-            except requests.exceptions.ConnectionError:
+                result = None
+                # Local models can take longer, especially on CPU or for longer text,
+                # so there's no read timeout; only connecting is bounded.
+                with httpx.stream(
+                    "POST",
+                    EVENTS_URL,
+                    json=payload,
+                    params={"persist": int(save_to_library)},
+                    timeout=httpx.Timeout(None, connect=10.0),
+                ) as response:
+                    if response.is_error:
+                        response.read()  # Needed before .json() on a streamed response
+                        response.raise_for_status()
+                    for line in response.iter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        event = json.loads(line[len("data: ") :])
+                        if event["status"] in STATUS_LABELS:
+                            status.update(label=STATUS_LABELS[event["status"]])
+                        else:
+                            result = event
+                            break
+
+                if result is None or result["status"] == "error":
+                    detail = (result or {}).get("detail", "No result returned by API.")
+                    status.update(label="Conversion failed", state="error")
+                    st.error(f"❌ API Error: {detail}")
+                elif save_to_library:
+                    status.update(label="Done", state="complete")
+                    returned_filename = result.get("filename", "audio.wav")
+                    st.success(
+                        f"✅ Success! Audio saved as '{returned_filename}' in the 'music' folder."
+                    )
+                    st.balloons()
+                    # st.session_state.text_area_content = "" # Optional: clear input
+                    st.experimental_rerun()  # Refresh audio list in sidebar
+                else:
+                    status.update(label="Done", state="complete")
+                    st.success("✅ Success! Audio generated (not saved).")
+                    st.audio(
+                        base64.b64decode(result["audio_b64"]),
+                        format=result.get("media_type", "audio/wav"),
+                    )
+            except httpx.ConnectError:
+                status.update(state="error")
                 st.error(
                     f"❌ Connection Error: Could not connect to the API. Is the FastAPI server running at {API_URL}?"
                 )
-            except requests.exceptions.HTTPError as e:
+            except httpx.HTTPStatusError as e:
+                status.update(state="error")
                 error_detail = "Could not retrieve error details from API."
                 try:
                     error_detail = e.response.json().get("detail", e.response.text)
                 except:  # pylint: disable=bare-except
                     pass
                 st.error(f"❌ API Error: {e.response.status_code} - {error_detail}")
-            except requests.exceptions.Timeout:
+            except httpx.TimeoutException:
+                status.update(state="error")
                 st.error(
-                    "❌ API Error: The request timed out. The text might be too long, or the local model is slow (especially on CPU)."
+                    "❌ API Error: The request timed out. Is the FastAPI server reachable?"
                 )
             except Exception as e:
+                status.update(state="error")
                 st.error(f"❌ An unexpected error occurred: {str(e)}")